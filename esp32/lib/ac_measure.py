@@ -0,0 +1,84 @@
+from utime import ticks_us, ticks_diff, ticks_add
+
+# ADC reads are scaled down by this many bits before squaring so the per sample square stays a small int
+SQUARE_SHIFT = 6
+
+
+def burst_read(adc, buf, period_us:int, count=None) -> int:
+    """ Read the adc (any object with read_uv) into the preallocated buffer, one sample every period_us.
+        Returns the measured sample period in nanoseconds """
+    if count is None:
+        count = len(buf)
+    read_uv = adc.read_uv
+    deadline = ticks_us()
+    start = deadline
+    now = deadline
+    for i in range(count):
+        now = ticks_us()
+        while ticks_diff(now, deadline) < 0:
+            now = ticks_us()
+        if i == 0:
+            start = now
+        buf[i] = read_uv()
+        deadline = ticks_add(deadline, period_us)
+    # reads fall behind the deadlines if the adc can't keep up, so use the actual spacing of the reads
+    return ticks_diff(now, start) * 1000 // (count - 1) if count > 1 else period_us * 1000
+
+
+def ac_stats(buf, count:int, period_ns:int, baseline:int, hysteresis:int=20000) -> tuple:
+    """ Calculate the AC figures for a burst of reads in uV.  The burst should cover an integer number of cycles.
+        Returns (rms_uv, peak_uv, crest_x1000, freq_mhz), freq_mhz is 0 if less than 2 cycles were seen """
+    # first pass, DC level of the signal for the zero crossings
+    total = 0
+    for i in range(count):
+        total += buf[i]
+    mean = total // count
+
+    # second pass, squares and peak against the baseline, rising crossings against the mean
+    sum_sq = 0
+    peak = 0
+    armed = False
+    crossings = 0
+    first = 0
+    last = 0
+    prev = buf[0] - mean
+    for i in range(count):
+        value = buf[i]
+        dev = (value - baseline) >> SQUARE_SHIFT
+        sum_sq += dev * dev
+        dev = value - baseline
+        if dev < 0:
+            dev = -dev
+        if dev > peak:
+            peak = dev
+        cur = value - mean
+        if cur < -hysteresis:
+            armed = True
+        elif armed and cur >= 0 and prev < 0:
+            # crossing position in 1/256 of a sample by linear interpolation
+            position = (i - 1) * 256 + (-prev * 256) // (cur - prev)
+            if crossings == 0:
+                first = position
+            last = position
+            crossings += 1
+            armed = False
+        prev = cur
+
+    rms = _isqrt((sum_sq << (2 * SQUARE_SHIFT)) // count)
+    crest = peak * 1000 // rms if rms > 0 else 0
+    freq = 0
+    if crossings >= 2 and last > first:
+        freq = (crossings - 1) * 256 * 1000000000000 // ((last - first) * period_ns)
+    return rms, peak, crest, freq
+
+
+def _isqrt(value:int) -> int:
+    """ Integer square root """
+    if value <= 0:
+        return 0
+    x = value
+    y = (x + 1) // 2
+    while y < x:
+        x = y
+        y = (x + value // x) // 2
+    return x
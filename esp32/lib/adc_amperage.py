@@ -2,23 +2,77 @@ import time
 import _thread
 import gc
 import uasyncio
+from array import array
+from heapq import heappush, heappop
 from machine import ADC, Pin, UART, freq
 from loglevel import INFO, ERROR, DEBUG
 from esp32_controller import BaseESP32Worker
+from ac_measure import burst_read, ac_stats
 from utime import ticks_ms, ticks_diff, sleep_ms
 
 
 # UART/Ethernet command list - 'LIST' is explicitly supported and returns a list of the commands
 COMMAND_LIST = [
     'CMD:INIT\\n - Initalize the ADC based ammeter.  Ammeter should have NO LOAD to zeroize the reading.',
-    'CMD:INTERVAL:{ms}\\n - Set a sampling interval in milliseconds for a pin (RAM only, does not update config file).',
+    'CMD:INTERVAL:{ms}[:{pin}]\\n - Set the default sampling interval in milliseconds (pins with their own interval keep it), or the interval of a pin by number or name (RAM only, does not update config file).',
+    'CMD:MODE:{DC|AC}\\n - Set the measurement mode (RAM only, does not update config file).',
     'CMD:START[:{timeout}]\\n - Start the sampling.  Timeout is 600 seconds if none is provided.',
     'CMD:STOP\\n - Stop the sampling.',
     'CMD:ONE\\n - Make a single reading and return the result.',
     'CMD:STATUS\\n - Return the current status',
-    'CMD:CONFIG\\n - Return the current configuration in the following: CONFIG:{interval}:{pin}:{name}[:{pin}:{name}...]'
+    'CMD:CONFIG\\n - Return the current configuration in the following: CONFIG:{interval}:{pin}:{name}[:{pin}:{name}...]',
+    'CMD:LOG[:{count}]\\n - Return the most recent log records (default 20) as LOG:{record} lines',
+    'CMD:LINK\\n - Return the link health in the following format: LINK:{host}:{rtt_ms}:{loss_percent}',
+    'CMD:SYNC:{epoch_us}\\n - Clock sync request from the host, returns SYNC:{epoch_us}:{device_epoch_us}',
+    'CMD:SYNC:{epoch_us}:{reply_epoch_us}\\n - Complete a clock sync using the host send and reply times, returns CLOCK:{epoch_ms}:{offset_us}:{drift_ppm}'
 ]
 
+
+class AdcPin:
+    """ Compiled settings for a single ADC pin """
+    __slots__ = ('pin', 'name', 'label', 'obj', 'baseline', 'mv_per_a', 'interval', 'avg_count')
+
+    def __init__(self, pin_conf:dict, interval:int, avg_count:int):
+        self.pin = int(pin_conf['pin'])
+        self.name = str(pin_conf.get('name', self.pin))
+        # record prefix, formatted once instead of on every read
+        self.label = f":{self.name}:"
+        self.obj = pin_conf.get('obj', None)
+        self.baseline = int(pin_conf.get('baseline', 2450000))
+        self.mv_per_a = int(pin_conf.get('mv_per_a', 185))
+        self.interval = int(pin_conf.get('interval', interval))
+        self.avg_count = int(pin_conf.get('avg_count', avg_count))
+        if self.mv_per_a <= 0 or self.interval < 1 or self.avg_count < 3:
+            raise ValueError(f'pin {self.pin} needs mv_per_a > 0, interval >= 1 and avg_count >= 3')
+
+
+class AdcRuntime:
+    """ Validated, flattened copy of config['adc'] read by the sampling loops instead of the config dict.
+        It is never changed in place, a new one is compiled and swapped in when the settings change. """
+    __slots__ = ('interval', 'avg_count', 'timeout', 'baseline_time', 'ac', 'ac_sample_rate', 'ac_count', 'ac_hysteresis', 'pins')
+
+    def __init__(self, adc_conf:dict):
+        self.interval = int(adc_conf.get('interval', 100))
+        if self.interval < 1:
+            raise ValueError('interval must be >= 1')
+        self.avg_count = int(adc_conf.get('avg_count', 5))
+        self.timeout = int(adc_conf.get('timeout', 600))
+        self.baseline_time = int(adc_conf.get('baseline_time', 10))
+        mode = adc_conf.get('mode', 'dc')
+        if mode not in ('dc', 'ac'):
+            raise ValueError(f'unknown mode {mode}')
+        self.ac = mode == 'ac'
+        ac_conf = adc_conf.get('ac', {})
+        self.ac_sample_rate = int(ac_conf.get('sample_rate', 4000))
+        self.ac_count = self.ac_sample_rate * int(ac_conf.get('cycles', 10)) // int(ac_conf.get('line_freq', 60))
+        self.ac_hysteresis = int(ac_conf.get('hysteresis', 20000))
+        if self.ac_count < 2:
+            raise ValueError('ac sample_rate is too low for the cycles and line_freq')
+        self.pins = tuple(AdcPin(pin_conf, self.interval, self.avg_count) for pin_conf in adc_conf['pins'])
+        if len(self.pins) == 0:
+            raise ValueError('no pins configured')
+
+
 class AdcAmperage(BaseESP32Worker):
     def __init__(self, **kwargs):
         self._stop_led = None
@@ -26,7 +80,12 @@ class AdcAmperage(BaseESP32Worker):
         self.init_stop_time = None
         self.baseline_task = None
         self.sampling_task = None
+        self.single_read_task = False
         self.sampling_stop_time = None
+        self._sync_request = None
+        self._ac_buffer = None
+        self._ac_single_buffer = None
+        self.runtime = None
         super().__init__(**kwargs)
 
     def run(self):
@@ -51,6 +110,8 @@ class AdcAmperage(BaseESP32Worker):
         except Exception as e:
             self.log(f'Error configuring ADC: {e}', ERROR)
             exit(1)
+        if not self.compile_runtime():
+            exit(1)
 
         # Create a variable to hold a break to stop reading as well as running status
         self.break_read = False
@@ -90,12 +151,75 @@ class AdcAmperage(BaseESP32Worker):
                 self.led_pin = Pin(self.config['init_button']['led_pin'], mode=Pin.OUT, value=0)
                 self._stop_led = True
 
+        # periodically discipline the clock against NTP if the network is up
+        if self.wlan is not None and self.config.get('clock', {}).get('sync_interval', 300) > 0:
+            uasyncio.create_task(self.clock_loop(self.config.get('clock', {}).get('sync_interval', 300)))
+
+        # monitor the link to the broker or NTP server if configured
+        if self.wlan is not None and 'link_monitor' in self.config:
+            uasyncio.create_task(self.link_monitor())
+
+        # write log records from the event loop so logging never waits on the console or flash
+        uasyncio.create_task(self.log_flush_loop())
+
         # set the cpu frequency to the minimum
         freq(80000000)
 
         # start the async main loop
         uasyncio.run(self.main_loop())
 
+    def load_config_file(self):
+        """ Reload the config file from flash and compile the ADC settings.  On a reload the ADC handles created by
+            run() are carried over by pin number, an invalid file keeps the previous config and runtime """
+        previous = self.config
+        if not super().load_config_file():
+            return False
+        try:
+            handles = {int(pin_conf['pin']): pin_conf['obj'] for pin_conf in previous.get('adc', {}).get('pins', []) if pin_conf.get('obj') is not None}
+            if len(handles) > 0:
+                for pin_conf in self.config['adc']['pins']:
+                    if int(pin_conf['pin']) not in handles:
+                        raise ValueError(f"pin {pin_conf['pin']} has no ADC, adding a pin needs a restart")
+                    pin_conf['obj'] = handles[int(pin_conf['pin'])]
+            self.runtime = AdcRuntime(self.config['adc'])
+            return True
+        except Exception as e:
+            self.log(f'Invalid ADC configuration, keeping the previous settings: {e}', ERROR)
+            # at boot there is nothing to go back to, run() refuses to start without a runtime
+            if previous:
+                self.config = previous
+        return False
+
+    def compile_runtime(self) -> bool:
+        """ Compile config['adc'] into an AdcRuntime and swap it in.  On error the previous runtime is kept """
+        try:
+            self.runtime = AdcRuntime(self.config['adc'])
+            return True
+        except Exception as e:
+            self.log(f'Invalid ADC configuration, keeping the previous settings: {e}', ERROR)
+        return False
+
+    def adc_config_copy(self) -> dict:
+        """ Return a copy of config['adc'] (and its pins) that can be changed and passed to update_adc_config """
+        adc_conf = self.config['adc'].copy()
+        adc_conf['pins'] = [pin_conf.copy() for pin_conf in adc_conf['pins']]
+        return adc_conf
+
+    def update_adc_config(self, adc_conf:dict) -> bool:
+        """ Compile a changed copy of config['adc'] and store it along with the runtime only if it is valid.
+            An invalid change is logged and returned as an ERROR on the UART, the current settings are kept """
+        try:
+            runtime = AdcRuntime(adc_conf)
+        except Exception as e:
+            self.log(f'Invalid ADC setting, keeping the previous settings: {e}', ERROR)
+            if self.uart is not None:
+                with self.uart_write_lock:
+                    self.uart.write(f"ERROR:Invalid setting {e}\n")
+            return False
+        self.config['adc'] = adc_conf
+        self.runtime = runtime
+        return True
+
     async def main_loop(self):
         """ Main processing loop """
         while True:
@@ -103,7 +227,7 @@ class AdcAmperage(BaseESP32Worker):
             if self.uart is not None:
                 if self.uart.any():
                     data = self.uart.readline().decode('utf-8')
-                    self.log("RECEIVED: " + data.replace('\n', '\\n'), DEBUG)
+                    self.log('RECEIVED: %r', DEBUG, data)
                     if len(data) >= 8: # 8 is the minimum command length! CMD:ONE\n
                         if data[0:4] == 'CMD:' and data[-1] == '\n':
                             data_parts = data.split(':')
@@ -123,16 +247,54 @@ class AdcAmperage(BaseESP32Worker):
 
                                 elif data_parts[1].replace('\n', '') == 'CONFIG':
                                     with self.uart_write_lock:
-                                        self.log(f'{self.get_config}', DEBUG)
                                         self.uart.write(f"{self.get_config}\n")
 
+                                elif data_parts[1].replace('\n', '') == 'LOG':
+                                    try:
+                                        count = int(data_parts[2]) if len(data_parts) >= 3 else 20
+                                    except ValueError:
+                                        with self.uart_write_lock:
+                                            self.uart.write(f"ERROR:Invalid count {data_parts[2].strip()}\n")
+                                    else:
+                                        for record in self.log_recent(count):
+                                            with self.uart_write_lock:
+                                                self.uart.write(f"LOG:{self.log_format(record)}\n")
+
+                                elif data_parts[1].replace('\n', '') == 'LINK':
+                                    with self.uart_write_lock:
+                                        self.uart.write(f"LINK:{self.link_host}:{self.link_rtt}:{self.link_loss}\n")
+
                                 elif data_parts[1].replace('\n', '') == 'INTERVAL':
                                     self.log('Received INTERVAL Command.  Setting sampling interval (in ram only, does not update the config file).', DEBUG)
-                                    if len(data_parts) >= 3:
-                                        self.config['adc']['interval'] = int(data_parts[2])
+                                    adc_conf = self.adc_config_copy()
+                                    try:
+                                        pin = data_parts[3].replace('\n', '') if len(data_parts) >= 4 else None
+                                        pin_confs = [pin_conf for pin_conf in adc_conf['pins'] if pin is not None and (str(pin_conf['pin']) == pin or pin_conf.get('name', None) == pin)]
+                                        if pin is not None and len(pin_confs) == 0:
+                                            with self.uart_write_lock:
+                                                self.uart.write(f"ERROR:Unknown pin {pin}\n")
+                                        else:
+                                            for pin_conf in pin_confs:
+                                                pin_conf['interval'] = int(data_parts[2])
+                                            if pin is None and len(data_parts) >= 3:
+                                                adc_conf['interval'] = int(data_parts[2])
+                                            self.update_adc_config(adc_conf)
+                                    except ValueError:
+                                        with self.uart_write_lock:
+                                            self.uart.write(f"ERROR:Invalid interval {data_parts[2].strip()}\n")
+
+                                elif data_parts[1].replace('\n', '') == 'MODE' and len(data_parts) >= 3 and data_parts[2].replace('\n', '').lower() in ('dc', 'ac'):
+                                    self.log('Received MODE Command.  Setting measurement mode (in ram only, does not update the config file).', DEBUG)
+                                    adc_conf = self.adc_config_copy()
+                                    adc_conf['mode'] = data_parts[2].replace('\n', '').lower()
+                                    self.update_adc_config(adc_conf)
 
                                 elif data_parts[1].replace('\n', '') == 'START':
-                                    if not self.sampling_task:
+                                    if self.single_read_task:
+                                        # a single AC burst is reading the ADC, sampling would read it at the same time
+                                        with self.uart_write_lock:
+                                            self.uart.write('ERROR:single read in progress\n')
+                                    elif not self.sampling_task:
                                         _thread.start_new_thread(self.start_sampling, () if len(data_parts) < 3 else (int(data_parts[2]),))
 
                                 elif data_parts[1].replace('\n', '') == 'STOP':
@@ -141,6 +303,15 @@ class AdcAmperage(BaseESP32Worker):
                                 elif data_parts[1].replace('\n', '') == 'ONE':
                                     uasyncio.create_task(self.read_ammeter())
 
+                                elif data_parts[1].replace('\n', '') == 'SYNC' and len(data_parts) >= 3:
+                                    try:
+                                        sync_times = [int(x) for x in data_parts[2:4]]
+                                    except ValueError:
+                                        with self.uart_write_lock:
+                                            self.uart.write(f"ERROR:Invalid sync {':'.join(data_parts[2:4]).strip()}\n")
+                                    else:
+                                        self.host_sync(*sync_times)
+
                                 else:
                                     self.log("Unknown command:" + data.replace('\n', ''), ERROR)
                                     with self.uart_write_lock:
@@ -175,6 +346,43 @@ class AdcAmperage(BaseESP32Worker):
             # wait the debounce interval before rechecking
             await uasyncio.sleep_ms(debounce)
 
+    async def clock_loop(self, interval=300):
+        """ Async process to discipline the clock against NTP """
+        while True:
+            if await self.ntp_sync() is not None:
+                self.clock_report()
+            await uasyncio.sleep(interval)
+
+    def host_sync(self, host_us, reply_us=None):
+        """ Two step clock sync with the host.  The host sends its time, the device replies with its own and
+            the host completes the exchange with the time the reply was received.  Commands are only polled every
+            100ms, so the request arrival time isn't known.  Instead the reply is stamped as it is sent and the
+            host time at that point is the reply receive time less the time to transmit the reply. """
+        if reply_us is None:
+            with self.uart_write_lock:
+                # wait for anything already queued so the reply goes out as soon as it is stamped
+                self.uart.flush()
+                tx_ticks = ticks_ms()
+                reply = f"SYNC:{host_us}:{self.clock.epoch_us(tx_ticks)}\n"
+                self.uart.write(reply)
+            # 10 bits per byte on the wire
+            self._sync_request = (host_us, tx_ticks, len(reply) * 10000000 // self.config['uart'].get('baudrate', 115200))
+        elif self._sync_request is not None and self._sync_request[0] == host_us:
+            self.clock.sync(reply_us - self._sync_request[2], self._sync_request[1], source='host')
+            self._sync_request = None
+            self.clock_report()
+        else:
+            self.log(f'Clock sync completion for unknown request {host_us}', ERROR)
+            with self.uart_write_lock:
+                self.uart.write(f"ERROR:Unknown sync request {host_us}\n")
+
+    def clock_report(self):
+        """ Send the current clock state to the host: CLOCK:{epoch_ms}:{offset_us}:{drift_ppm} """
+        self.log('Clock offset %dus, drift %dppm (%s)', DEBUG, self.clock.offset_us, self.clock.drift_ppm, self.clock.source)
+        if self.uart is not None:
+            with self.uart_write_lock:
+                self.uart.write(f"CLOCK:{self.clock.epoch_ms()}:{self.clock.offset_us}:{self.clock.drift_ppm}\n")
+
     async def led_flash(self, timeout=60, flashrate=.5):
         """ Async process to flash the LED """
         if self.led_pin is not None:
@@ -236,18 +444,25 @@ class AdcAmperage(BaseESP32Worker):
         self.log('baseline start', DEBUG)
         # Start the sampling
         init_seconds = self.config['adc'].get('baseline_time', 10)
-        for adc_conf in self.config['adc']['pins']:
+        # baselines are applied together once all pins are done, to a fresh copy so commands handled meanwhile are kept
+        baselines = {}
+        for pin in self.runtime.pins:
             self.init_stop_time = time.time() + init_seconds
-            self.log(f"Starting baseline of the ADC Ammeter. Running for {init_seconds} seconds on {adc_conf.get('name', adc_conf['pin'])}", INFO)
+            self.log(f"Starting baseline of the ADC Ammeter. Running for {init_seconds} seconds on {pin.name}", INFO)
             value_list = []
             while time.time() < self.init_stop_time:
                 # Read the ADC
-                value_list.append(adc_conf['obj'].read_uv())
+                value_list.append(pin.obj.read_uv())
                 gc.collect()
                 await uasyncio.sleep_ms(self.config['adc'].get('interval', 100))
             # calculate baseline value
-            adc_conf['baseline'] = int(sum(value_list) / len(value_list))
-            self.log(f"{adc_conf.get('name', adc_conf['pin'])} baseline is {adc_conf['baseline']}", INFO)
+            baselines[pin.pin] = int(sum(value_list) / len(value_list))
+            self.log(f"{pin.name} baseline is {baselines[pin.pin]}", INFO)
+        new_conf = self.adc_config_copy()
+        for adc_conf in new_conf['pins']:
+            if int(adc_conf['pin']) in baselines:
+                adc_conf['baseline'] = baselines[int(adc_conf['pin'])]
+        self.update_adc_config(new_conf)
 
         self.baseline_task = False
         with self._lock:
@@ -264,40 +479,66 @@ class AdcAmperage(BaseESP32Worker):
             freq(240000000)
 
             # set the stoptime
-            self.sampling_stop_time = time.time() + (timeout if timeout is not None else self.config['adc'].get('timeout', 600))
+            runtime = self.runtime
+            self.sampling_stop_time = time.time() + (timeout if timeout is not None else runtime.timeout)
 
-            # create a list to hold X number of records to average in
-            for adc_conf in self.config['adc']['pins']:
-                adc_conf['log'] = [0] * self.config['adc'].get('avg_count', 5)
-            self.log(f"Starting amperage sampling for all pins. Stop in {self.config['adc'].get('timeout', 600)} seconds", INFO)
+            # create a list per pin to hold X number of records to average in
+            logs = [[0] * pin.avg_count for pin in runtime.pins]
+            self.log(f"Starting amperage sampling for all pins. Stop in {runtime.timeout} seconds", INFO)
 
             # write the start time back for marking purposes
             with self.uart_write_lock:
-                self.uart.write(f'START:{time.time()}\n')
-
-            # read count used to populate the log
-            read_count = self.config['adc'].get('avg_count', 5)
-            start_ticks = ticks_ms()
-            while time.time() < self.sampling_stop_time:
-                record = "DATA"
-                for adc_conf in self.config['adc']['pins']:
-                    ticks = ticks_diff(ticks_ms(), start_ticks)
-                    amps = _calc_amperage(adc_conf['obj'].read_uv(), adc_conf.get('baseline', 2450000), adc_conf.get('mv_per_a', 185))
-                    adc_conf['log'][read_count % self.config['adc'].get('avg_count', 5)] = amps
-                    # discard highest and lowest value
-                    log_temp = adc_conf['log'].copy()
-                    log_temp.sort()
-                    log_temp = log_temp[1:len(log_temp) - 1]
-                    record += f":{adc_conf.get('name', adc_conf['pin'])}:{ticks}:{amps}:{log_temp}:{sum(log_temp) / len(log_temp)}"
-                read_count += 1
-                with self.uart_write_lock:
-                    self.uart.write(f"{record}\n")
+                self.uart.write(f'START:{self.clock.epoch_ms()}:{self.clock.offset_us}:{self.clock.drift_ppm}\n')
+
+            if runtime.ac:
+                # one window per pin every interval
+                while time.time() < self.sampling_stop_time:
+                    record = self.read_ac()
+                    with self.uart_write_lock:
+                        self.uart.write(f"{record}\n")
+                    sleep_ms(self.runtime.interval)
+            else:
+                # min-heap of (due ms since start, pin index), each pin is only read when it is due
+                read_counts = [0] * len(runtime.pins)
+                schedule = []
+                for i in range(len(runtime.pins)):
+                    heappush(schedule, (0, i))
+                start_ticks = ticks_ms()
+                while time.time() < self.sampling_stop_time:
+                    # settings changed by a command are picked up on the next pass
+                    runtime = self.runtime
+                    pins = runtime.pins
+                    record = "DATA"
+                    elapsed = ticks_diff(ticks_ms(), start_ticks)
+                    while schedule[0][0] <= elapsed:
+                        due, i = heappop(schedule)
+                        pin = pins[i]
+                        log = logs[i]
+                        timestamp = self.clock.epoch_ms()
+                        amps = _calc_amperage(pin.obj.read_uv(), pin.baseline, pin.mv_per_a)
+                        log[read_counts[i] % len(log)] = amps
+                        read_counts[i] += 1
+                        # discard highest and lowest value
+                        log_temp = log.copy()
+                        log_temp.sort()
+                        log_temp = log_temp[1:len(log_temp) - 1]
+                        record += f"{pin.label}{timestamp}:{amps}:{log_temp}:{sum(log_temp) / len(log_temp)}"
+                        # schedule the next read, skipping any slots that were missed rather than catching up in a burst
+                        due += pin.interval
+                        if due <= elapsed:
+                            due = elapsed + pin.interval
+                        heappush(schedule, (due, i))
+                    if len(record) > 4:
+                        with self.uart_write_lock:
+                            self.uart.write(f"{record}\n")
 
-                sleep_ms(self.config['adc'].get('interval', 100))
+                    # sleep until the next pin is due, waking at least every global interval to check for a stop
+                    sleep_ms(max(0, min(schedule[0][0] - ticks_diff(ticks_ms(), start_ticks), runtime.interval)))
 
             with self.uart_write_lock:
-                self.log(f'STOP:{time.time()}', DEBUG)
-                self.uart.write(f'STOP:{time.time()}\n')
+                stop_ms = self.clock.epoch_ms()
+                self.log('STOP:%d', DEBUG, stop_ms)
+                self.uart.write(f'STOP:{stop_ms}\n')
             self.log('Stopping amperage sampling for all pins.')
             self.sampling_task = False
             with self._lock:
@@ -311,7 +552,7 @@ class AdcAmperage(BaseESP32Worker):
             self.log("Stop of samling requested.", INFO)
             self.sampling_stop_time = time.time()
             # wait for 2x the interval
-            await uasyncio.sleep_ms(self.config['adc'].get('interval', 100) * 2)
+            await uasyncio.sleep_ms(self.runtime.interval * 2)
 
             if self.sampling_task:
                 with self.uart_write_lock:
@@ -321,24 +562,68 @@ class AdcAmperage(BaseESP32Worker):
         """ Perform a read of the ammeter using the  """
         # read count used to populate the log
         self.log('Starting single read', DEBUG)
-        read_count = self.config['adc'].get('avg_count', 5)
-        for adc_conf in self.config['adc']['pins']:
-            adc_conf['log'] = [0] * self.config['adc'].get('avg_count', 5)
-        start_ticks = ticks_ms()
+        runtime = self.runtime
+        if runtime.ac:
+            # a burst busy waits for each pin, so it can't share the ADC with sampling or run on the event loop
+            if self.sampling_task:
+                with self.uart_write_lock:
+                    self.uart.write('ERROR:sampling in progress\n')
+            elif self.single_read_task:
+                with self.uart_write_lock:
+                    self.uart.write('ERROR:single read in progress\n')
+            else:
+                # set on the event loop before the thread starts so a following ONE or START sees it
+                self.single_read_task = True
+                _thread.start_new_thread(self.read_ac_single, ())
+            return
+        read_count = runtime.avg_count
+        logs = [[0] * runtime.avg_count for _ in runtime.pins]
+        timestamps = [0] * len(runtime.pins)
         for i in range(read_count):
-            for adc_conf in self.config['adc']['pins']:
-                ticks = ticks_diff(ticks_ms(), start_ticks)
-                amps = _calc_amperage(adc_conf['obj'].read_uv(), adc_conf.get('baseline', 2450000), adc_conf.get('mv_per_a', 185))
-                adc_conf['log'][i] = amps
-            read_count += 1
-            await uasyncio.sleep_ms(self.config['adc'].get('interval', 100))
+            for j, pin in enumerate(runtime.pins):
+                timestamps[j] = self.clock.epoch_ms()
+                logs[j][i] = _calc_amperage(pin.obj.read_uv(), pin.baseline, pin.mv_per_a)
+            await uasyncio.sleep_ms(runtime.interval)
+        # each pin reports its own latest read and the time of that read
         record = "DATA"
-        for adc_conf in self.config['adc']['pins']:
-            record += f":{adc_conf.get('name', adc_conf['pin'])}:{ticks}:{amps}:{adc_conf['log']}:{sum(adc_conf['log']) / len(adc_conf['log'])}"
+        for pin, log, timestamp in zip(runtime.pins, logs, timestamps):
+            record += f"{pin.label}{timestamp}:{log[-1]}:{log}:{sum(log) / len(log)}"
         with self.uart_write_lock:
             self.log(record, DEBUG)
             self.uart.write(f"{record}\n")
 
+    def read_ac_single(self) -> None:
+        """ Make a single AC reading and write the result, run in a thread by read_ammeter """
+        try:
+            record = self.read_ac(single=True)
+            with self.uart_write_lock:
+                self.log(record, DEBUG)
+                self.uart.write(f"{record}\n")
+        finally:
+            self.single_read_task = False
+
+    def read_ac(self, single=False) -> str:
+        """ Burst read each pin over a whole number of mains cycles and return the AC figures in the following format:
+            AC:{name}:{timestamp}:{rms}:{peak}:{crest}:{freq}[:{name}...]
+            A single reading uses its own buffer, read_ammeter only allows one at a time and never during sampling.
+        """
+        runtime = self.runtime
+        buffer = self._ac_single_buffer if single else self._ac_buffer
+        if buffer is None or len(buffer) != runtime.ac_count:
+            buffer = array('i', [0] * runtime.ac_count)
+            if single:
+                self._ac_single_buffer = buffer
+            else:
+                self._ac_buffer = buffer
+        record = "AC"
+        for pin in runtime.pins:
+            timestamp = self.clock.epoch_ms()
+            period_ns = burst_read(pin.obj, buffer, 1000000 // runtime.ac_sample_rate)
+            rms, peak, crest, freq_mhz = ac_stats(buffer, runtime.ac_count, period_ns, pin.baseline, runtime.ac_hysteresis)
+            uv_per_a = pin.mv_per_a * 1000.0
+            record += f"{pin.label}{timestamp}:{rms / uv_per_a}:{peak / uv_per_a}:{crest / 1000}:{freq_mhz / 1000}"
+        return record
+
 
 def _calc_amperage(adc_read:int, adc_baseline:int, mv_per_amp:int) -> float:
     """ Calculate the amperage based on the ready, baseline, max amperage of the sensor and zero point voltage of the sensor """
@@ -1,10 +1,20 @@
 import json
+import _thread
 from time import sleep, localtime, time
 import network
 #from umqtt.robust import MQTTClient
 import ntptime
+import usocket
+import ustruct
+import uasyncio
+from utime import ticks_ms, ticks_diff, ticks_add
+from tickclock import TickClock
+from uping import aping
 from custom_mqtt import mqtt_custom as MQTTClient
-from loglevel import log_str, DEBUG, INFO, ERROR
+from loglevel import log_str, RingLog, DEBUG, INFO, WARNING, ERROR
+
+# seconds between the NTP epoch (1900) and the unix epoch (1970)
+NTP_DELTA = 2208988800
 
 
 class BaseESP32Worker:
@@ -15,6 +25,16 @@ class BaseESP32Worker:
         self.wlan = None
         self.config = {}
         self.mqtt = None
+        self.log_ring = RingLog()
+        self._log_level = INFO
+        self._log_async = False
+        self._log_time = (None, '')
+        self.clock = TickClock()
+        self.link_host = None
+        self.link_rtt = None
+        self.link_loss = 0
+        self._ntp_addr = None
+        self._mqtt_reconnecting = False
         self.load_config_file()
         self.network_ready()
         if 'mqtt' in self.config:
@@ -28,6 +48,10 @@ class BaseESP32Worker:
             input_file = open(self._config_file, 'r', encoding='utf-8')
             self.config = json.loads(input_file.read())
             input_file.close()
+            # records are kept if they are going to the console or the ring buffer
+            self._log_level = max(self.config.get('logging_console', INFO), self.config.get('logging_buffer', INFO))
+            if self.config.get('log_buffer', 50) != len(self.log_ring.records):
+                self.log_ring.resize(self.config.get('log_buffer', 50))
             return True
         except Exception as e:
             self.log(f'Cannot open config file. Error: {e}', ERROR)
@@ -67,6 +91,8 @@ class BaseESP32Worker:
                 self.log(f'Syncing time to {self.config.get("ntp_server", "0.us.pool.ntp.org")}...', INFO)
                 ntptime.host = self.config.get('ntp_server', '0.us.pool.ntp.org')
                 ntptime.settime()
+                # resolve the NTP server once here, getaddrinfo blocks on the DNS lookup
+                self._ntp_addr = usocket.getaddrinfo(ntptime.host, 123)[0][-1]
             except Exception as e:
                 self.log(f'Error connecting to wifi: {e}', ERROR)
                 self.wlan.active(False)
@@ -81,6 +107,107 @@ class BaseESP32Worker:
 
         return self.wlan.isconnected() if self.wlan is not None else False
 
+    async def ntp_sync(self, timeout=1000):
+        """ Discipline the tick clock against the NTP server without blocking the event loop,
+            returns the offset applied in us or None on error """
+        try:
+            if self._ntp_addr is None:
+                self._ntp_addr = usocket.getaddrinfo(self.config.get('ntp_server', '0.us.pool.ntp.org'), 123)[0][-1]
+            query = bytearray(48)
+            query[0] = 0x1B
+            s = usocket.socket(usocket.AF_INET, usocket.SOCK_DGRAM)
+            try:
+                s.setblocking(False)
+                sent = ticks_ms()
+                s.sendto(query, self._ntp_addr)
+                msg = None
+                while msg is None and ticks_diff(ticks_ms(), sent) < timeout:
+                    try:
+                        msg = s.recv(48)
+                    except OSError:
+                        # nothing received yet, yield to the event loop
+                        await uasyncio.sleep_ms(1)
+                received = ticks_ms()
+            finally:
+                s.close()
+            if msg is None:
+                raise OSError(f'no reply in {timeout}ms')
+            # server transmit time is taken as the midpoint of the round trip
+            secs, frac = ustruct.unpack('!II', msg[40:48])
+            epoch_us = (secs - NTP_DELTA) * 1000000 + (frac * 1000000 >> 32)
+            offset = self.clock.sync(epoch_us, ticks_add(sent, ticks_diff(received, sent) // 2), source='ntp')
+            self.log('NTP clock sync offset %dus, drift %dppm, rtt %dms', DEBUG, offset, self.clock.drift_ppm, ticks_diff(received, sent))
+            return offset
+        except Exception as e:
+            self.log(f'Error syncing clock to NTP: {e}', ERROR)
+        return None
+
+    async def network_reconnect(self, timeout=30):
+        """ Reconnect to the network if it is down without blocking the event loop, then reconnect MQTT if configured.
+            If the network is still up only MQTT is reconnected, the far end is down rather than the wifi """
+        try:
+            if self.wlan is None or not self.wlan.isconnected():
+                self.log(f"Reconnecting to network ssid {self.config['network']['ssid']}...", level=INFO)
+                if self.wlan is None:
+                    self.wlan = network.WLAN(network.STA_IF)
+                    self.wlan.active(True)
+                self.wlan.disconnect()
+                self.wlan.connect(self.config['network']['ssid'], self.config['network']['psk'])
+                start = ticks_ms()
+                while not self.wlan.isconnected() and ticks_diff(ticks_ms(), start) < timeout * 1000:
+                    await uasyncio.sleep_ms(500)
+        except Exception as e:
+            self.log(f'Error reconnecting to wifi: {e}', ERROR)
+        if self.wlan is not None and self.wlan.isconnected() and 'mqtt' in self.config and not self._mqtt_reconnecting:
+            # mqtt_connect blocks on DNS and the socket timeouts, run it in a thread to keep the event loop running
+            self._mqtt_reconnecting = True
+            _thread.start_new_thread(self._mqtt_reconnect_thread, ())
+
+    def _mqtt_reconnect_thread(self):
+        """ Reconnect MQTT, started in a thread by network_reconnect """
+        try:
+            self.mqtt_connect()
+        finally:
+            self._mqtt_reconnecting = False
+
+    async def link_monitor(self):
+        """ Async process to ping the MQTT broker (or NTP server) and track the round trip time and loss.
+            Reconnects once max_failures pings in a row are lost, before sends to the server start failing """
+        conf = self.config.get('link_monitor', {})
+        host = conf.get('host', self.config['mqtt']['config']['server'] if 'mqtt' in self.config else self.config.get('ntp_server', '0.us.pool.ntp.org'))
+        try:
+            # resolve once, aping needs an address so the event loop is never blocked on DNS
+            self.link_host = usocket.getaddrinfo(host, 1)[0][-1][0]
+        except Exception as e:
+            self.log(f'Link monitor cannot resolve {host}: {e}', ERROR)
+            return
+        self.log(f'Starting link monitor to {host} ({self.link_host})...', INFO)
+        results = bytearray(conf.get('window', 20))
+        count = 0
+        failures = 0
+        seq = 0
+        while True:
+            seq = (seq + 1) & 0x7fff
+            try:
+                rtt = await aping(self.link_host, timeout=conf.get('timeout', 1000), seq=seq)
+            except Exception as e:
+                self.log(f'Error pinging {self.link_host}: {e}', ERROR)
+                rtt = None
+            # ring buffer of the last window results, 1 for a lost ping
+            results[count % len(results)] = 1 if rtt is None else 0
+            count += 1
+            self.link_loss = sum(results) * 100 // min(count, len(results))
+            if rtt is None:
+                failures += 1
+                self.log('Ping to %s lost, %d in a row, %d%% loss', DEBUG, self.link_host, failures, self.link_loss)
+            else:
+                failures = 0
+                self.link_rtt = rtt if self.link_rtt is None else (self.link_rtt * 7 + rtt) / 8
+            if failures >= conf.get('max_failures', 3):
+                await self.network_reconnect()
+                failures = 0
+            await uasyncio.sleep(conf.get('interval', 10))
+
     def mqtt_connect(self):
         """ Connect to MQTT server if not connected """
         if self.mqtt is not None:
@@ -120,7 +247,7 @@ class BaseESP32Worker:
     def mqtt_send(self, **kwargs):
         """ Send an mqtt message with error handling to reconnect """
         try:
-            self.log(f'Sending MQTT message to {kwargs["topic"] if "topic" in kwargs.keys() else "???"}...', DEBUG)
+            self.log('Sending MQTT message to %s...', DEBUG, kwargs.get('topic', '???'))
             self.mqtt.publish(**kwargs)
         except Exception as e:
             self.log(f'Error sending MQTT message: {e}', ERROR)
@@ -156,15 +283,70 @@ class BaseESP32Worker:
         self.log('No run code was provided', INFO)
         return
 
-    def localtime(self, string=True):
-        """ returns the current localtime """
+    def localtime(self, string=True, timestamp=None):
+        """ returns the current localtime (or the localtime of timestamp) """
         tz = self.config.get('timezone', -7) if self.config is not None else 0
-        now_tz = localtime(time() + tz * 3600)
+        now_tz = localtime((time() if timestamp is None else timestamp) + tz * 3600)
         if string:
-            return f'{now_tz[0]}-{now_tz[1]}-{now_tz[2]} {"0" + str(now_tz[3]) if now_tz[3] < 10 else now_tz[3] }:{"0" + str(now_tz[4]) if now_tz[4] < 10 else now_tz[4] }:{"0" + str(now_tz[5]) if now_tz[5] < 10 else now_tz[5]} {"UTC" if tz == 0 else self.config.get("timezone_name", "ERR")}'
+            return '%d-%d-%d %02d:%02d:%02d %s' % (now_tz[0], now_tz[1], now_tz[2], now_tz[3], now_tz[4], now_tz[5], "UTC" if tz == 0 else self.config.get("timezone_name", "ERR"))
         return now_tz
 
-    def log(self, message, level=INFO, console=True):
-        """ Log the message """
-        if console and (self.config is None or level <= self.config.get('logging_console', INFO)):
-            print(f'{self.localtime()} - {log_str(level)} - {message}')
+    def log(self, message, level=INFO, *args, console=True):
+        """ Log the message.  Any args are formatted into the message with % only when the record is written,
+            so filtered calls cost a single comparison.  Records are buffered in log_ring and written by
+            log_flush, immediately unless log_flush_loop is running. """
+        if level > self._log_level:
+            return
+        self.log_ring.append((int(time()), level, message, args, console))
+        if not self._log_async:
+            self.log_flush()
+
+    def log_format(self, record) -> str:
+        """ Format a log record from log_ring as a line """
+        timestamp, level, message, args, _ = record
+        # the time string only changes once a second
+        if self._log_time[0] != timestamp:
+            self._log_time = (timestamp, self.localtime(timestamp=timestamp))
+        if args:
+            try:
+                message = message % args
+            except Exception:
+                message = f'{message} {args}'
+        return f'{self._log_time[1]} - {log_str(level)} - {message}'
+
+    def log_flush(self):
+        """ Write any log records not yet flushed to the console and the log file (logging_file) if configured """
+        dropped, records = self.log_ring.pending()
+        console_level = self.config.get('logging_console', INFO) if self.config is not None else INFO
+        lines = []
+        if dropped:
+            lines.append(f'{self.localtime()} - {log_str(WARNING)} - {dropped} log records dropped before flush')
+        for record in records:
+            if record[4] and record[1] <= console_level:
+                lines.append(self.log_format(record))
+        if len(lines) == 0:
+            return
+        for line in lines:
+            print(line)
+        if self.config is not None and self.config.get('logging_file', None) is not None:
+            try:
+                with open(self.config['logging_file'], 'a', encoding='utf-8') as output_file:
+                    output_file.write('\n'.join(lines) + '\n')
+            except Exception as e:
+                print(f'Cannot write log file: {e}')
+
+    def log_recent(self, count=20) -> list:
+        """ Return up to count of the most recent log records at or below the logging_buffer level """
+        buffer_level = self.config.get('logging_buffer', INFO) if self.config is not None else INFO
+        records = [record for record in self.log_ring.last(len(self.log_ring.records)) if record[1] <= buffer_level]
+        return records[-count:] if count > 0 else []
+
+    async def log_flush_loop(self, interval=200):
+        """ Async process to flush the log, once started log() only buffers records """
+        self._log_async = True
+        while True:
+            try:
+                self.log_flush()
+            except Exception as e:
+                print(f'Error flushing log: {e}')
+            await uasyncio.sleep_ms(interval)
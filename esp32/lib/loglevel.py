@@ -1,3 +1,5 @@
+import _thread
+
 DEBUG = 7
 INFO = 6
 NOTICE = 5
@@ -15,3 +17,48 @@ def log_str(level:int):
     if 0 <= level <= 7:
         return log_level_strings[level]
     return 'OUT-OF-RANGE'
+
+
+class RingLog:
+    """ Fixed size ring buffer of log records.  Records are stored unformatted, the writer tracks how many
+        have been flushed so the same buffer serves as the flush queue and the recent history.
+        Records are added from the sampling thread as well as the event loop, so all access is locked. """
+    def __init__(self, size=50):
+        self.records = [None] * max(1, int(size))
+        self.count = 0
+        self.flushed = 0
+        self._lock = _thread.allocate_lock()
+
+    def resize(self, size:int):
+        """ Change the size of the buffer (at least 1), keeping the most recent records """
+        size = max(1, int(size))
+        with self._lock:
+            records = self._last(size)
+            self.records = records + [None] * (size - len(records))
+            self.flushed = max(0, self.flushed - (self.count - len(records)))
+            self.count = len(records)
+
+    def append(self, record):
+        """ Add a record, overwriting the oldest once the buffer is full """
+        with self._lock:
+            self.records[self.count % len(self.records)] = record
+            self.count += 1
+
+    def last(self, count:int) -> list:
+        """ Return up to count of the most recent records, oldest first """
+        with self._lock:
+            return self._last(count)
+
+    def _last(self, count:int) -> list:
+        end = self.count
+        start = max(0, end - count, end - len(self.records))
+        return [self.records[i % len(self.records)] for i in range(start, end)]
+
+    def pending(self) -> tuple:
+        """ Return (dropped, records) for the records not yet flushed, dropped is the number overwritten before a flush """
+        with self._lock:
+            end = self.count
+            dropped = max(0, end - len(self.records) - self.flushed)
+            records = self._last(end - self.flushed - dropped)
+            self.flushed = end
+        return dropped, records
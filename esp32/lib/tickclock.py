@@ -0,0 +1,68 @@
+from time import time, gmtime
+from utime import ticks_ms, ticks_diff
+
+# offset from the micropython epoch to the unix epoch (2000-01-01 on most ports, 1970-01-01 on some)
+EPOCH_OFFSET = 946684800 if gmtime(0)[0] == 2000 else 0
+MAX_DRIFT_PPM = 500
+
+
+class TickClock:
+    """ Mapping of ticks_ms to unix epoch microseconds, disciplined by NTP or host sync exchanges.
+
+        Each sync measures the offset between the current mapping and the reference and estimates
+        the crystal drift from the offset seen over the time since the previous sync.  The mapping
+        is kept in a single tuple so the sampling thread always reads a consistent anchor.  The drift
+        is measured against a separate reference that only moves when the drift is updated, so
+        frequent syncs still accumulate the span needed for an estimate. """
+    def __init__(self, min_drift_span=60):
+        self.min_drift_span = min_drift_span
+        self.offset_us = 0
+        self.source = None
+        self._anchor = None # (ticks_ms, epoch_us, drift_ppm)
+        self._drift_ref = None # (ticks_ms, epoch_us) of the sync the drift is measured from
+
+    @property
+    def drift_ppm(self) -> int:
+        """ Estimated drift of the local ticks, positive if the local clock is slow """
+        return self._anchor[2] if self._anchor is not None else 0
+
+    def sync(self, epoch_us:int, ticks=None, source='ntp') -> int:
+        """ Discipline the clock to a reference epoch_us measured at ticks, returns the offset in us """
+        if ticks is None:
+            ticks = ticks_ms()
+        anchor = self._anchor
+        # step against the current mapping, including an anchor taken from the RTC before the first sync
+        self.offset_us = epoch_us - self.epoch_us(ticks) if anchor is not None else 0
+        drift = anchor[2] if anchor is not None else 0
+        reference = self._drift_ref
+        if reference is None:
+            # first reference, there is no earlier sync to estimate the drift from
+            self._drift_ref = (ticks, epoch_us)
+        else:
+            span_ms = ticks_diff(ticks, reference[0])
+            if span_ms >= self.min_drift_span * 1000:
+                # error over the span against the reference with the current drift, any steps in between don't matter
+                elapsed_us = span_ms * 1000
+                error_us = epoch_us - (reference[1] + elapsed_us + elapsed_us * drift // 1000000)
+                # apply half of the measured error to smooth out network jitter
+                drift += error_us * 500 // span_ms
+                drift = max(-MAX_DRIFT_PPM, min(MAX_DRIFT_PPM, drift))
+                self._drift_ref = (ticks, epoch_us)
+        self.source = source
+        self._anchor = (ticks, epoch_us, drift)
+        return self.offset_us
+
+    def epoch_us(self, ticks=None) -> int:
+        """ Return the unix epoch in microseconds for the ticks value (default now) """
+        if ticks is None:
+            ticks = ticks_ms()
+        anchor = self._anchor
+        if anchor is None:
+            # not synced yet, anchor to the RTC
+            anchor = self._anchor = (ticks, int(time() + EPOCH_OFFSET) * 1000000, 0)
+        elapsed_us = ticks_diff(ticks, anchor[0]) * 1000
+        return anchor[1] + elapsed_us + elapsed_us * anchor[2] // 1000000
+
+    def epoch_ms(self, ticks=None) -> int:
+        """ Return the unix epoch in milliseconds for the ticks value (default now) """
+        return self.epoch_us(ticks) // 1000
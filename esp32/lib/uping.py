@@ -2,23 +2,38 @@
 # copyright (c) 2018 Shawwwn <shawwwn1@gmail.com>
 # License: MIT
 
+from sys import byteorder
+
 # Internet Checksum Algorithm
 # Author: Olav Morken
 # https://github.com/olavmrk/python-ping/blob/master/ping.py
+# Sums the packet as native 16 bit words with array('H') (micropython copies the buffer directly),
+# the one's complement sum is byte order independent so the result is swapped back to network order
+# https://www.rfc-editor.org/rfc/rfc1071
 # @data: bytes
 def checksum(data):
+    from array import array
     if len(data) & 0x1: # Odd number of bytes
-        data += b'\0'
-    cs = 0
-    for pos in range(0, len(data), 2):
-        b1 = data[pos]
-        b2 = data[pos + 1]
-        cs += (b1 << 8) + b2
+        data = bytes(data) + b'\0'
+    cs = sum(array('H', data))
     while cs >= 0x10000:
         cs = (cs & 0xffff) + (cs >> 16)
     cs = ~cs & 0xffff
+    if byteorder == 'little':
+        cs = ((cs & 0xff) << 8) | (cs >> 8)
     return cs
 
+def _pkt_desc():
+    import uctypes
+    return {
+        "type": uctypes.UINT8 | 0,
+        "code": uctypes.UINT8 | 1,
+        "checksum": uctypes.UINT16 | 2,
+        "id": uctypes.UINT16 | 4,
+        "seq": uctypes.INT16 | 6,
+        "timestamp": uctypes.UINT64 | 8,
+    } # packet header descriptor
+
 def ping(host, count=4, timeout=5000, interval=10, quiet=False, size=64):
     import utime
     import uselect
@@ -30,14 +45,7 @@ def ping(host, count=4, timeout=5000, interval=10, quiet=False, size=64):
     # prepare packet
     assert size >= 16, "pkt size too small"
     pkt = b'Q'*size
-    pkt_desc = {
-        "type": uctypes.UINT8 | 0,
-        "code": uctypes.UINT8 | 1,
-        "checksum": uctypes.UINT16 | 2,
-        "id": uctypes.UINT16 | 4,
-        "seq": uctypes.INT16 | 6,
-        "timestamp": uctypes.UINT64 | 8,
-    } # packet header descriptor
+    pkt_desc = _pkt_desc()
     h = uctypes.struct(uctypes.addressof(pkt), pkt_desc, uctypes.BIG_ENDIAN)
     h.type = 8 # ICMP_ECHO_REQUEST
     h.code = 0
@@ -105,3 +113,47 @@ def ping(host, count=4, timeout=5000, interval=10, quiet=False, size=64):
     ret = (n_trans, n_recv)
     not quiet and print("%u packets transmitted, %u packets received" % (n_trans, n_recv))
     return (n_trans, n_recv)
+
+async def aping(host, timeout=1000, size=64, seq=1, poll_ms=5):
+    """ Send a single ICMP echo without blocking the uasyncio event loop.
+        Returns the round trip time in ms, or None if no reply was received within timeout ms.
+        Pass an IP address, resolving a host name with getaddrinfo blocks on the DNS lookup. """
+    import utime
+    import uctypes
+    import usocket
+    import urandom
+    import uasyncio
+
+    # prepare packet
+    assert size >= 16, "pkt size too small"
+    pkt = b'Q'*size
+    pkt_desc = _pkt_desc()
+    h = uctypes.struct(uctypes.addressof(pkt), pkt_desc, uctypes.BIG_ENDIAN)
+    h.type = 8 # ICMP_ECHO_REQUEST
+    h.code = 0
+    h.checksum = 0
+    h.id = urandom.randint(0, 65535)
+    h.seq = seq
+    h.timestamp = utime.ticks_us()
+    h.checksum = checksum(pkt)
+
+    sock = usocket.socket(usocket.AF_INET, usocket.SOCK_RAW, 1)
+    try:
+        sock.setblocking(False)
+        sock.connect((usocket.getaddrinfo(host, 1)[0][-1][0], 1))
+        sock.send(pkt)
+        start = utime.ticks_ms()
+        while utime.ticks_diff(utime.ticks_ms(), start) < timeout:
+            try:
+                resp = sock.recv(256)
+            except OSError:
+                # nothing received yet, yield to the event loop
+                await uasyncio.sleep_ms(poll_ms)
+                continue
+            resp_mv = memoryview(resp)
+            h2 = uctypes.struct(uctypes.addressof(resp_mv[20:]), pkt_desc, uctypes.BIG_ENDIAN)
+            if h2.type==0 and h2.id==h.id and h2.seq==seq: # 0: ICMP_ECHO_REPLY
+                return utime.ticks_diff(utime.ticks_us(), h2.timestamp) / 1000
+    finally:
+        sock.close()
+    return None
@@ -0,0 +1,340 @@
+""" Host side aggregator for one or more ADC ammeters, one serial port per device.
+
+    Drives every device with the CMD:INIT / CMD:START / CMD:STOP commands, reads all of the
+    DATA streams concurrently and writes each channel to append-only .npy files on a common
+    timeline.  Only the standard library is required, numpy is only needed to read the output:
+
+        numpy.load('capture/ttyUSB0/sensor1pin32.amps.npy', mmap_mode='r')
+
+    Any tty works as a port, including the slave side of a pty for testing with fake devices.
+"""
+import argparse
+import array
+import asyncio
+import json
+import os
+import sys
+import termios
+import time
+import tty
+
+
+# .npy format v1.0 with a fixed 128 byte header so the shape can be rewritten in place
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+NPY_HEADER_SIZE = 128
+NPY_DTYPES = {'d': '<f8', 'q': '<i8'}
+
+BAUDRATES = {
+    9600: termios.B9600,
+    19200: termios.B19200,
+    38400: termios.B38400,
+    57600: termios.B57600,
+    115200: termios.B115200,
+    230400: termios.B230400,
+}
+
+
+class NpyAppendFile:
+    """ Append-only 1-D .npy file.  Values are buffered in an array of chunk_size items and
+        written when full; the header is rewritten with the current length on every flush so
+        the file is always loadable (or memory mappable) while a capture is running. """
+    def __init__(self, path, typecode='d', chunk_size=4096):
+        self.path = path
+        self.typecode = typecode
+        self.chunk_size = chunk_size
+        self.length = 0
+        self._buffer = array.array(typecode)
+        self._file = open(path, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        """ Write the .npy header for the current length at the start of the file """
+        header = f"{{'descr': '{NPY_DTYPES[self.typecode]}', 'fortran_order': False, 'shape': ({self.length},), }}"
+        header = header.ljust(NPY_HEADER_SIZE - len(NPY_MAGIC) - 3) + '\n'
+        self._file.seek(0)
+        self._file.write(NPY_MAGIC + len(header).to_bytes(2, 'little') + header.encode('latin1'))
+
+    def append(self, value):
+        """ Add a value, writing the buffer out once chunk_size values are pending """
+        self._buffer.append(value)
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """ Write any buffered values and update the header """
+        if len(self._buffer) == 0:
+            return
+        if sys.byteorder != 'little':
+            self._buffer.byteswap()
+        self._file.seek(0, os.SEEK_END)
+        self._buffer.tofile(self._file)
+        self.length += len(self._buffer)
+        self._buffer = array.array(self.typecode)
+        self._write_header()
+        self._file.flush()
+
+    def close(self):
+        """ Flush and close the file """
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+
+DC_COLUMNS = ('amps', 'avg')
+AC_COLUMNS = ('rms', 'peak', 'crest', 'freq')
+
+
+class ChannelWriter:
+    """ Columnar output for a single channel of a device: time plus one float column per value """
+    def __init__(self, path_prefix, columns=DC_COLUMNS, chunk_size=4096):
+        self.t_ms = NpyAppendFile(f'{path_prefix}.t_ms.npy', 'q', chunk_size)
+        self.columns = [NpyAppendFile(f'{path_prefix}.{column}.npy', 'd', chunk_size) for column in columns]
+
+    def append(self, t_ms, *values):
+        """ Add a single sample to each column """
+        self.t_ms.append(t_ms)
+        for column, value in zip(self.columns, values):
+            column.append(value)
+
+    def close(self):
+        """ Close all columns """
+        self.t_ms.close()
+        for column in self.columns:
+            column.close()
+
+
+class AmmeterDevice:
+    """ A single ammeter connected on a serial port """
+    def __init__(self, port, name=None, baudrate=115200, line_limit=65536):
+        self.port = port
+        self.name = name if name is not None else os.path.basename(port)
+        self.baudrate = baudrate
+        self.line_limit = line_limit
+        self.start_ms = None
+        self.clock_log = []
+        self.stopped = False
+        self._fd = None
+        self._reader = None
+        self._transport = None
+
+    async def open(self):
+        """ Open the port in raw mode and attach a stream reader to it """
+        self._fd = os.open(self.port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        tty.setraw(self._fd)
+        attrs = termios.tcgetattr(self._fd)
+        attrs[4] = attrs[5] = BAUDRATES.get(self.baudrate, termios.B115200)
+        termios.tcsetattr(self._fd, termios.TCSANOW, attrs)
+        loop = asyncio.get_running_loop()
+        self._reader = asyncio.StreamReader(limit=self.line_limit)
+        self._transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(self._reader),
+                                                          os.fdopen(self._fd, 'rb', buffering=0, closefd=False))
+
+    def close(self):
+        """ Close the port """
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def send(self, command):
+        """ Send a command, the CMD: prefix and newline are added """
+        os.write(self._fd, f'CMD:{command}\n'.encode())
+
+    async def readline(self, timeout=None):
+        """ Read a single line from the device without the newline.  Returns None at EOF """
+        line = await asyncio.wait_for(self._reader.readline(), timeout)
+        if not line:
+            return None
+        return line.decode('utf-8', errors='replace').rstrip('\r\n')
+
+    async def wait_for(self, prefix, timeout=None):
+        """ Read lines until one starting with prefix is received and return it """
+        while True:
+            line = await self.readline(timeout)
+            if line is None:
+                raise EOFError(f'{self.name} closed while waiting for {prefix}')
+            if line.startswith(prefix):
+                return line
+
+
+def parse_data(line):
+    """ Split a DATA line into a list of (name, timestamp, amps, average) tuples:
+        DATA:{NAME}:{TIMESTAMP}:{AMPS}:{LAST_READS}:{AVERAGE}[:{NAME}:...] """
+    parts = line.split(':')
+    samples = []
+    for i in range(1, len(parts) - 4, 5):
+        samples.append((parts[i], int(parts[i + 1]), float(parts[i + 2]), float(parts[i + 4])))
+    return samples
+
+
+def parse_ac(line):
+    """ Split an AC line into a list of (name, timestamp, rms, peak, crest, freq) tuples:
+        AC:{NAME}:{TIMESTAMP}:{RMS}:{PEAK}:{CREST}:{FREQ}[:{NAME}:...] """
+    parts = line.split(':')
+    samples = []
+    for i in range(1, len(parts) - 5, 6):
+        samples.append((parts[i], int(parts[i + 1])) + tuple(float(value) for value in parts[i + 2:i + 6]))
+    return samples
+
+
+def parse_clock(line):
+    """ Split a START or CLOCK line into (epoch_ms, offset_us, drift_ppm):
+        START:{EPOCH_MS}:{OFFSET_US}:{DRIFT_PPM} """
+    parts = line.split(':')
+    return int(parts[1]), int(parts[2]), int(parts[3])
+
+
+class Aggregator:
+    """ Drive several ammeters at once and write their samples onto a common timeline.
+
+        Each device timestamps its samples in unix epoch milliseconds from its own disciplined
+        clock.  Before sampling the clock of each device is synced to the host with the
+        CMD:SYNC exchange so all devices and host side events share the same timeline.  Output
+        is one directory per device with t_ms/amps/avg .npy columns per channel and a run.json
+        describing the capture. """
+    def __init__(self, ports, output_dir, baudrate=115200, chunk_size=4096):
+        self.devices = [AmmeterDevice(port, baudrate=baudrate) for port in ports]
+        self.output_dir = output_dir
+        self.chunk_size = chunk_size
+        self._writers = {}
+
+    def _writer(self, device, channel, columns=DC_COLUMNS):
+        """ Get or create the writer for a device channel """
+        key = (device.name, channel)
+        if key not in self._writers:
+            device_dir = os.path.join(self.output_dir, device.name)
+            os.makedirs(device_dir, exist_ok=True)
+            self._writers[key] = ChannelWriter(os.path.join(device_dir, channel), columns, self.chunk_size)
+        return self._writers[key]
+
+    async def init(self, timeout=120):
+        """ Baseline all devices concurrently, returns when every device reports READY """
+        for device in self.devices:
+            device.send('INIT')
+        await asyncio.gather(*(self._wait_ready(device, timeout) for device in self.devices))
+
+    async def sync(self, timeout=2):
+        """ Sync the clock of all devices to the host """
+        await asyncio.gather(*(self._sync_device(device, timeout) for device in self.devices))
+
+    async def _sync_device(self, device, timeout):
+        """ Two step sync: send the host time, then the time the reply was received """
+        host_us = time.time_ns() // 1000
+        device.send(f'SYNC:{host_us}')
+        await device.wait_for(f'SYNC:{host_us}:', timeout=timeout)
+        device.send(f'SYNC:{host_us}:{time.time_ns() // 1000}')
+        device.clock_log.append(parse_clock(await device.wait_for('CLOCK:', timeout=timeout)))
+
+    async def _wait_ready(self, device, timeout):
+        """ Poll the device status until it is ready, raises TimeoutError if it is not ready within timeout seconds """
+        deadline = time.monotonic() + timeout
+        status = None
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f'{device.name} not ready after {timeout}s, last status {status}')
+            await asyncio.sleep(min(1, remaining))
+            device.send('STATUS')
+            try:
+                status = await device.wait_for('STATUS:', timeout=max(deadline - time.monotonic(), 0.1))
+            except asyncio.TimeoutError:
+                raise TimeoutError(f'{device.name} not ready after {timeout}s, last status {status}') from None
+            if status.startswith('STATUS:READY'):
+                return
+
+    async def _ingest(self, device):
+        """ Read the stream from a device until STOP or EOF.  Garbled or over long lines are reported and skipped """
+        while not device.stopped:
+            try:
+                line = await device.readline()
+            except ValueError as e:
+                # the stream reader discards a line over line_limit and raises, the next line reads normally
+                print(f'{device.name}: skipped line: {e}', file=sys.stderr)
+                continue
+            if line is None:
+                break
+            try:
+                self._ingest_line(device, line)
+            except (ValueError, IndexError) as e:
+                print(f'{device.name}: bad line ({e}): {line}', file=sys.stderr)
+
+    def _ingest_line(self, device, line):
+        """ Handle a single line from a device, a line is parsed completely before anything is written """
+        if line.startswith('START:'):
+            device.start_ms = parse_clock(line)[0]
+        elif line.startswith('CLOCK:'):
+            device.clock_log.append(parse_clock(line))
+        elif line.startswith('STOP:'):
+            device.stopped = True
+        elif line.startswith('DATA:') and device.start_ms is not None:
+            for name, timestamp, amps, avg in parse_data(line):
+                self._writer(device, name).append(timestamp, amps, avg)
+        elif line.startswith('AC:') and device.start_ms is not None:
+            for name, timestamp, *values in parse_ac(line):
+                self._writer(device, name, AC_COLUMNS).append(timestamp, *values)
+        elif line.startswith('ERROR:'):
+            print(f'{device.name}: {line}', file=sys.stderr)
+
+    async def capture(self, timeout=600, init=False, sync=True):
+        """ Open all devices, optionally baseline them, sync their clocks then sample for timeout seconds """
+        os.makedirs(self.output_dir, exist_ok=True)
+        for device in self.devices:
+            await device.open()
+        try:
+            if init:
+                await self.init()
+            if sync:
+                await self.sync()
+            ingest = {asyncio.create_task(self._ingest(device)): device for device in self.devices}
+            for device in self.devices:
+                device.send(f'START:{timeout}')
+            # devices stop themselves at the timeout, send a STOP if any are still running after a grace period
+            done, pending = await asyncio.wait(ingest, timeout=timeout + 10)
+            for task in done:
+                if task.exception() is not None:
+                    print(f'{ingest[task].name}: capture failed: {task.exception()!r}', file=sys.stderr)
+                    if not ingest[task].stopped:
+                        ingest[task].send('STOP')
+            if pending:
+                for device in self.devices:
+                    if not device.stopped:
+                        device.send('STOP')
+                await asyncio.wait(pending, timeout=5)
+                for task in pending:
+                    task.cancel()
+        finally:
+            for device in self.devices:
+                device.close()
+            self.close()
+
+    def close(self):
+        """ Flush all channel files and write the run description """
+        for writer in self._writers.values():
+            writer.close()
+        starts = [device.start_ms for device in self.devices if device.start_ms is not None]
+        with open(os.path.join(self.output_dir, 'run.json'), 'w', encoding='utf-8') as output_file:
+            json.dump({
+                'origin_ms': min(starts) if starts else None,
+                'devices': {device.name: {'port': device.port, 'start_ms': device.start_ms, 'clock': device.clock_log} for device in self.devices},
+                'channels': {f'{device}/{channel}': writer.t_ms.length for (device, channel), writer in self._writers.items()},
+            }, output_file, indent=4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Capture from one or more ADC ammeters into .npy files')
+    parser.add_argument('ports', nargs='+', help='Serial ports, one per device')
+    parser.add_argument('-o', '--output', default='capture', help='Output directory')
+    parser.add_argument('-t', '--timeout', type=int, default=600, help='Sampling time in seconds')
+    parser.add_argument('-b', '--baudrate', type=int, default=115200)
+    parser.add_argument('--init', action='store_true', help='Baseline the devices before sampling (NO LOAD!)')
+    parser.add_argument('--no-sync', action='store_true', help='Do not sync the device clocks to the host')
+    parser.add_argument('--chunk-size', type=int, default=4096, help='Samples buffered per column before writing')
+    args = parser.parse_args()
+    aggregator = Aggregator(args.ports, args.output, baudrate=args.baudrate, chunk_size=args.chunk_size)
+    asyncio.run(aggregator.capture(timeout=args.timeout, init=args.init, sync=not args.no_sync))
+
+
+if __name__ == '__main__':
+    main()
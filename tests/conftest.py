@@ -0,0 +1,8 @@
+""" Make the host tools and the micropython modules that only need utime importable from the tests """
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'host'))
+sys.path.insert(0, os.path.join(ROOT, 'esp32', 'lib'))
+sys.path.insert(0, os.path.join(ROOT, 'tests', 'shim'))
@@ -0,0 +1,31 @@
+""" Host stand-in for the micropython utime tick functions.  Time only moves when advance() is called
+    (or ticks_us is polled), so simulated devices control exactly when each read happens. """
+TICKS_PER_POLL = 5
+now_us = 0
+
+
+def advance(us):
+    global now_us
+    now_us += us
+
+
+def ticks_us():
+    # a busy wait on the ticks has to make progress
+    advance(TICKS_PER_POLL)
+    return now_us
+
+
+def ticks_ms():
+    return now_us // 1000
+
+
+def ticks_diff(end, start):
+    return end - start
+
+
+def ticks_add(ticks, delta):
+    return ticks + delta
+
+
+def sleep_ms(ms):
+    advance(ms * 1000)
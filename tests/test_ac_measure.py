@@ -0,0 +1,74 @@
+""" AC burst capture and statistics against a simulated ADC reading a sine """
+import math
+import random
+from array import array
+
+import pytest
+import utime
+
+from ac_measure import burst_read, ac_stats
+
+BASELINE = 2450000
+MV_PER_A = 185
+
+
+class SineAdc:
+    """ Simulated ADC, each read takes read_us and returns the sensor output in uV for a sine current """
+    def __init__(self, amps_rms, line_freq, dc_amps=0.0, read_us=40, noise_uv=0):
+        self.amplitude_uv = amps_rms * math.sqrt(2) * MV_PER_A * 1000
+        self.dc_uv = dc_amps * MV_PER_A * 1000
+        self.line_freq = line_freq
+        self.read_us = read_us
+        self.noise_uv = noise_uv
+        self.phase = random.random() * 2 * math.pi
+
+    def read_uv(self):
+        t = utime.now_us / 1000000
+        utime.advance(self.read_us)
+        noise = random.randint(-self.noise_uv, self.noise_uv) if self.noise_uv else 0
+        return int(BASELINE + self.dc_uv + self.amplitude_uv * math.sin(2 * math.pi * self.line_freq * t + self.phase) + noise)
+
+
+def measure(adc, sample_rate=4000, line_freq=60, cycles=10):
+    count = sample_rate * cycles // line_freq
+    buf = array('i', [0] * count)
+    period_ns = burst_read(adc, buf, 1000000 // sample_rate)
+    return period_ns, ac_stats(buf, count, period_ns, BASELINE)
+
+
+@pytest.mark.parametrize('line_freq', [50, 60])
+@pytest.mark.parametrize('amps', [1.0, 5.0, 12.5])
+def test_sine_rms_peak_crest_and_frequency(line_freq, amps):
+    random.seed(line_freq + amps)
+    period_ns, (rms, peak, crest, freq_mhz) = measure(SineAdc(amps, line_freq, noise_uv=3000), line_freq=line_freq)
+    assert abs(period_ns - 250000) < 1000
+    assert rms / (MV_PER_A * 1000) == pytest.approx(amps, rel=0.01)
+    assert peak / (MV_PER_A * 1000) == pytest.approx(amps * math.sqrt(2), rel=0.02)
+    assert crest / 1000 == pytest.approx(math.sqrt(2), rel=0.02)
+    assert freq_mhz / 1000 == pytest.approx(line_freq, abs=0.1)
+
+
+def test_off_nominal_frequency():
+    random.seed(1)
+    _, (_, _, _, freq_mhz) = measure(SineAdc(5.0, 59.5), line_freq=60)
+    assert freq_mhz / 1000 == pytest.approx(59.5, abs=0.1)
+
+
+def test_dc_component_is_included_in_rms():
+    random.seed(2)
+    _, (rms, _, _, freq_mhz) = measure(SineAdc(3.0, 60, dc_amps=4.0))
+    assert rms / (MV_PER_A * 1000) == pytest.approx(5.0, rel=0.01)
+    assert freq_mhz / 1000 == pytest.approx(60, abs=0.1)
+
+
+def test_slow_adc_uses_measured_period():
+    # reads take longer than the requested period, the frequency must still come out right
+    random.seed(3)
+    period_ns, (_, _, _, freq_mhz) = measure(SineAdc(5.0, 60, read_us=400))
+    assert period_ns > 400000
+    assert freq_mhz / 1000 == pytest.approx(60, abs=0.1)
+
+
+def test_no_signal():
+    _, (rms, peak, crest, freq_mhz) = measure(SineAdc(0.0, 60))
+    assert (rms, peak, crest, freq_mhz) == (0, 0, 0, 0)
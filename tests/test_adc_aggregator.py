@@ -0,0 +1,113 @@
+""" Capture from fake ammeters on ptys with the host aggregator """
+import array
+import asyncio
+import json
+import os
+import pty
+import threading
+
+import pytest
+
+from adc_aggregator import Aggregator, NPY_HEADER_SIZE
+
+START_MS = 1700000000000
+
+
+class FakeAmmeter(threading.Thread):
+    """ Answers SYNC, STATUS and START on the master side of a pty.  lines are written between START and STOP """
+    def __init__(self, lines, status='STATUS:READY'):
+        super().__init__(daemon=True)
+        self.lines = lines
+        self.status = status
+        self.master, slave = pty.openpty()
+        self.port = os.ttyname(slave)
+
+    def write(self, line):
+        os.write(self.master, f'{line}\n'.encode())
+
+    def run(self):
+        buffer = b''
+        while True:
+            buffer += os.read(self.master, 256)
+            while b'\n' in buffer:
+                line, buffer = buffer.split(b'\n', 1)
+                parts = line.decode().split(':')
+                if parts[1] == 'SYNC' and len(parts) == 3:
+                    self.write(f'SYNC:{parts[2]}:{START_MS * 1000}')
+                elif parts[1] == 'SYNC':
+                    self.write(f'CLOCK:{START_MS}:-5:3')
+                elif parts[1] == 'STATUS':
+                    self.write(self.status)
+                elif parts[1] == 'START':
+                    self.write(f'START:{START_MS}:-5:3')
+                    for line_out in self.lines:
+                        self.write(line_out)
+                    self.write(f'STOP:{START_MS + 1000}')
+                    return
+
+
+def read_npy(path, typecode):
+    with open(path, 'rb') as input_file:
+        data = input_file.read()
+    assert data.startswith(b'\x93NUMPY\x01\x00')
+    values = array.array(typecode, data[NPY_HEADER_SIZE:])
+    assert f"'shape': ({len(values)},)".encode() in data[:NPY_HEADER_SIZE]
+    return list(values)
+
+
+def capture(tmp_path, *line_sets, chunk_size=4):
+    devices = [FakeAmmeter(lines) for lines in line_sets]
+    for device in devices:
+        device.start()
+    aggregator = Aggregator([device.port for device in devices], str(tmp_path), chunk_size=chunk_size)
+    asyncio.run(asyncio.wait_for(aggregator.capture(timeout=1), 20))
+    return aggregator
+
+
+def test_capture_two_devices(tmp_path):
+    lines = [f'DATA:s1:{START_MS + i * 100}:{i * 0.5}:[0, 0]:{i * 0.25}:s2:{START_MS + i * 100 + 3}:1.0:[0]:1.0' for i in range(10)]
+    aggregator = capture(tmp_path, lines, lines[:3])
+    first, second = (device.name for device in aggregator.devices)
+    assert read_npy(tmp_path / first / 's1.t_ms.npy', 'q') == [START_MS + i * 100 for i in range(10)]
+    assert read_npy(tmp_path / first / 's1.amps.npy', 'd') == [i * 0.5 for i in range(10)]
+    assert read_npy(tmp_path / second / 's2.avg.npy', 'd') == [1.0] * 3
+    run = json.loads((tmp_path / 'run.json').read_text())
+    assert run['origin_ms'] == START_MS
+    assert run['devices'][first]['clock'] == [[START_MS, -5, 3]]
+    assert run['channels'][f'{first}/s2'] == 10
+
+
+def test_capture_ac_records(tmp_path):
+    capture(tmp_path, [f'AC:a1:{START_MS + i}:5.0:7.07:1.414:59.98' for i in range(5)])
+    device_dir = next(path for path in tmp_path.iterdir() if path.is_dir())
+    assert read_npy(device_dir / 'a1.freq.npy', 'd') == [59.98] * 5
+    assert read_npy(device_dir / 'a1.rms.npy', 'd') == [5.0] * 5
+
+
+def test_garbled_lines_are_skipped(tmp_path, capsys):
+    lines = [
+        f'DATA:p1:{START_MS}:0.5:[1]:0.2',
+        'DATA:p1:12x:0.5:[1]:0.2',
+        'DATA:p1:' + 'x' * 70000,
+        f'DATA:p1:{START_MS + 100}:0.6:[1]:0.3',
+    ]
+    capture(tmp_path, lines)
+    device_dir = next(path for path in tmp_path.iterdir() if path.is_dir())
+    assert read_npy(device_dir / 'p1.amps.npy', 'd') == [0.5, 0.6]
+    assert 'bad line' in capsys.readouterr().err
+
+
+def test_init_times_out(tmp_path):
+    device = FakeAmmeter([], status='STATUS:INITIALIZING')
+    device.start()
+    aggregator = Aggregator([device.port], str(tmp_path))
+
+    async def init():
+        await aggregator.devices[0].open()
+        try:
+            await aggregator.init(timeout=2)
+        finally:
+            aggregator.devices[0].close()
+
+    with pytest.raises(TimeoutError, match=f'{aggregator.devices[0].name} not ready after 2s, last status STATUS:INITIALIZING'):
+        asyncio.run(asyncio.wait_for(init(), 10))
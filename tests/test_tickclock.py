@@ -0,0 +1,25 @@
+""" Clock discipline against a simulated reference for a slow local crystal """
+import pytest
+
+from tickclock import TickClock
+
+EPOCH_US = 1700000000000000
+
+
+@pytest.mark.parametrize('sync_every', [5, 30, 120])
+def test_drift_estimated_with_frequent_syncs(sync_every):
+    clock = TickClock()
+    ticks = 0
+    for _ in range(200):
+        # local ticks run 100ppm slow against the reference
+        clock.sync(EPOCH_US + ticks * 1000 + ticks // 10, ticks=ticks, source='host')
+        ticks += sync_every * 1000
+    assert 95 <= clock.drift_ppm <= 105
+    assert abs(clock.offset_us) <= sync_every * 5
+
+
+def test_first_sync_keeps_drift():
+    clock = TickClock()
+    assert clock.sync(EPOCH_US, ticks=0, source='ntp') == 0
+    clock.sync(EPOCH_US + 10000 * 1000 + 1000, ticks=10000, source='host')
+    assert clock.drift_ppm == 0